@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html import escape
 from PySide2 import QtGui, QtCore, QtWidgets
 import Metashape
 
@@ -10,6 +13,99 @@ https://github.com/matjash
 
 """
 
+_PROJECT_SUFFIXES = frozenset(('.psz', '.psx'))
+MAX_WORKERS = 8
+TABLE_BATCH_SIZE = 200
+SCAN_TICK_SECONDS = 0.05
+
+# Asset types stored as chunk collections that can be passed to chunk.remove()
+REMOVABLE_ASSETS = {
+    "Depth Maps": "depth_maps_sets",
+    "Point Clouds": "point_clouds",
+    "Models": "models",
+    "Tiled Models": "tiled_models",
+    "DEMs": "elevations",
+    "Orthomosaics": "orthomosaics",
+}
+
+
+def _same_path(path, other):
+    if not other:
+        return False
+    return os.path.normcase(os.path.abspath(path)) == os.path.normcase(os.path.abspath(other))
+
+
+def _looks_valid(entry):
+    # Rejects empty files and .psx files without their .files folder before doc.open()
+    try:
+        if entry.stat(follow_symlinks=False).st_size == 0:
+            return False
+    except OSError:
+        # Deleted or unreadable in the meantime; skip only this entry
+        return False
+    if os.path.splitext(entry.name)[1].lower() == '.psx':
+        return os.path.isdir(entry.path[:-4] + '.files')
+    return True
+
+
+def _iter_projects(root, skipped):
+    # Yields project paths and None after each directory; invalid projects go to skipped
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in _PROJECT_SUFFIXES and not entry.is_symlink():
+                        if _looks_valid(entry):
+                            yield entry.path
+                        else:
+                            skipped.append(entry.path)
+        except OSError as e:
+            print(f"Skipping {path}: {e}")
+        yield None
+
+
+# Handlers return True when something was removed and None when there was nothing to remove
+def _remove_key_points(chunk):
+    if not chunk.tie_points:
+        return None
+    chunk.tie_points.removeKeypoints()
+    return True
+
+
+def _remove_tie_points(chunk):
+    if not chunk.tie_points:
+        return None
+    chunk.tie_points = None
+    return True
+
+
+def _remove_orthophotos(chunk):
+    if not chunk.orthomosaics:
+        return None
+    for ortho in chunk.orthomosaics:
+        ortho.removeOrthophotos()
+    return True
+
+
+def _remove_shapes(chunk):
+    if chunk.shapes is None or len(chunk.shapes) == 0:
+        return None
+    chunk.shapes = None
+    return True
+
+
+ASSET_HANDLERS = {
+    "Key Points": _remove_key_points,
+    "Tie Points": _remove_tie_points,
+    "Orthophotos": _remove_orthophotos,
+    "Shapes": _remove_shapes,
+}
+
+
 class CleanUpDlg(QtWidgets.QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -44,6 +140,12 @@ class CleanUpDlg(QtWidgets.QDialog):
         self.checkboxes["DEMs"].setChecked(True)
         self.checkboxes["Point Clouds"].setChecked(True)
 
+        # Restore the selection from the previous run
+        self.settings = QtCore.QSettings("Metashape-scripts", "CleanUp")
+        for asset, checkbox in self.checkboxes.items():
+            checkbox.setChecked(self.settings.value("sel/" + asset, checkbox.isChecked(), type=bool))
+        self.finished.connect(self.save_settings)
+
         for checkbox in self.checkboxes.values():
             self.layout.addWidget(checkbox)
 
@@ -66,8 +168,15 @@ class CleanUpDlg(QtWidgets.QDialog):
 
         self.setLayout(self.layout)
 
+    def save_settings(self):
+        for asset, checkbox in self.checkboxes.items():
+            self.settings.setValue("sel/" + asset, checkbox.isChecked())
+
     def get_selected_assets(self):
-        return [asset for asset, checkbox in self.checkboxes.items() if checkbox.isChecked()]
+        return tuple(asset for asset, checkbox in self.checkboxes.items() if checkbox.isChecked())
+
+    def warn_no_assets(self):
+        QtWidgets.QMessageBox.information(self, "No assets", "Select at least one asset.")
 
     def confirm_removal(self, assets, projects):
         assets_message = ', '.join(assets)
@@ -82,56 +191,176 @@ class CleanUpDlg(QtWidgets.QDialog):
                                                QtWidgets.QMessageBox.No)
         return reply == QtWidgets.QMessageBox.Yes
 
-    def handle_assets(self, chunk, asset_type):
-        try:
-            if asset_type == "Key Points":
-                if chunk.tie_points:
-                    chunk.tie_points.removeKeypoints()
-            elif asset_type == "Tie Points":
-                chunk.tie_points = None
-            elif asset_type == "Depth Maps":
-                chunk.remove(chunk.depth_maps_sets)
-            elif asset_type == "Point Clouds":
-                chunk.remove(chunk.point_clouds)
-            elif asset_type == "Models":
-                chunk.remove(chunk.models)
-            elif asset_type == "Tiled Models":
-                chunk.remove(chunk.tiled_models)
-            elif asset_type == "DEMs":
-                chunk.remove(chunk.elevations)
-            elif asset_type == "Orthophotos":
-                for ortho in chunk.orthomosaics:
-                    ortho.removeOrthophotos()
-            elif asset_type == "Orthomosaics":
-                chunk.remove(chunk.orthomosaics)
-            elif asset_type == "Shapes":
-                chunk.shapes = None
+    def handle_assets(self, chunk, assets):
+        # Returns (asset, success, error) per asset; success is None when there was nothing to remove
+        results = {}
+        errors = {}
+        to_remove = []
+        batched = []
+        for asset_type in assets:
+            try:
+                if asset_type in REMOVABLE_ASSETS:
+                    collection = getattr(chunk, REMOVABLE_ASSETS[asset_type])
+                    if not collection:
+                        results[asset_type] = None
+                        continue
+                    to_remove.extend(collection)
+                    batched.append(asset_type)
+                    continue
+                handler = ASSET_HANDLERS.get(asset_type)
+                if handler is None:
+                    results[asset_type] = False
+                    errors[asset_type] = "unknown asset type"
+                    continue
+                results[asset_type] = handler(chunk)
+            except Exception as e:
+                results[asset_type] = False
+                errors[asset_type] = e
+
+        if batched:
+            try:
+                chunk.remove(to_remove)
+                for asset_type in batched:
+                    results[asset_type] = True
+            except Exception as e:
+                # Check what was removed per asset type
+                for asset_type in batched:
+                    try:
+                        removed = not getattr(chunk, REMOVABLE_ASSETS[asset_type])
+                    except Exception:
+                        removed = False
+                    results[asset_type] = removed
+                    if not removed:
+                        errors[asset_type] = e
+
+        return [(asset_type, results[asset_type], errors.get(asset_type)) for asset_type in assets]
+
+    def asset_log(self, target, results):
+        log = []
+        for asset, success, error in results:
+            if success is None:
+                log.append((f"No {asset} to remove from {target}", "gray"))
+            elif success:
+                log.append((f"Successfully removed {asset} from {target}", "black"))
             else:
-                print("Unknown asset type: " + asset_type)
-                return False
-            print(asset_type + " removed from " + chunk.label)
-            return True
-        except Exception as e:
-            print(f"Failed to remove {asset_type} from {chunk.label}: {e}")
-            return False
+                log.append((f"Failed to remove {asset} from {target}: {error}", "red"))
+        return log
 
     def remove_from_project(self):
-        chunk = Metashape.app.document.chunk
         selected_assets = self.get_selected_assets()
-        assets = [asset for asset in selected_assets]
-        projects = [chunk.label]
-        log = []
+        if not selected_assets:
+            self.warn_no_assets()
+            return
+
+        chunk = Metashape.app.document.chunk
 
-        if self.confirm_removal(assets, projects):
-            for asset in selected_assets:
-                success = self.handle_assets(chunk, asset)
-                if success:
-                    log.append((f"Successfully removed {asset} from {chunk.label}", "black"))
-                else:
-                    log.append((f"Failed to remove {asset} from {chunk.label}", "red"))
-            self.show_log(log)
+        if self.confirm_removal(selected_assets, (chunk.label,)):
+            self.show_log(self.asset_log(chunk.label, self.handle_assets(chunk, selected_assets)))
+
+    def clean_project(self, file_path, selected_assets, doc=None):
+        # Returns the cleaned, unsaved document (None on failure) and its log
+        try:
+            if doc is None:
+                doc = Metashape.Document()
+                doc.open(file_path)
+            return doc, self.asset_log(file_path, self.handle_assets(doc.chunk, selected_assets))
+        except Exception as e:
+            return None, [(f"Failed to open or process {file_path}: {e}", "red")]
+
+    def save_project(self, doc, file_path):
+        try:
+            doc.save()
+        except Exception as e:
+            return [(f"Failed to save {file_path}: {e}", "red")]
+        return []
+
+    def clean_projects(self, file_paths, selected_assets):
+        # Cleans projects in groups of MAX_WORKERS, then saves each group
+        progress = QtWidgets.QProgressDialog("Cleaning projects...", "Cancel", 0, len(file_paths), self)
+        progress.setWindowModality(QtCore.Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        progress.setAutoReset(False)
+        progress.setAutoClose(False)
+        progress.setValue(0)
+
+        def wait_for(futures):
+            # Keep the GUI responsive while the workers run
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future
+                QtWidgets.QApplication.processEvents()
+                # Cancel hides the dialog; show it until the running group finishes
+                if progress.wasCanceled() and not progress.isVisible():
+                    progress.setLabelText("Cancelling after the current projects...")
+                    progress.show()
+
+        logs = {}
+        finished = 0
+
+        def advance():
+            # A project counts as finished once it is saved or has failed to clean
+            nonlocal finished
+            finished += 1
+            progress.setValue(finished)
+
+        # Block a second run while this one is in progress
+        buttons = (self.remove_button, self.select_button, self.subfolders_button, self.exit_button)
+        for button in buttons:
+            button.setEnabled(False)
+        try:
+            # The open project is cleaned in place, on the GUI thread
+            live_doc = Metashape.app.document
+            pooled = []
+            for file_path in file_paths:
+                if not _same_path(file_path, live_doc.path):
+                    pooled.append(file_path)
+                    continue
+                doc, logs[file_path] = self.clean_project(file_path, selected_assets, live_doc)
+                if doc is not None:
+                    logs[file_path].extend(self.save_project(doc, file_path))
+                advance()
+
+            # Cancel takes effect between groups
+            for start in range(0, len(pooled), MAX_WORKERS):
+                if progress.wasCanceled():
+                    break
+                group = pooled[start:start + MAX_WORKERS]
+                docs = {}
+                with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                    progress.setLabelText("Cleaning projects...")
+                    futures = {executor.submit(self.clean_project, file_path, selected_assets): file_path
+                               for file_path in group}
+                    for future in wait_for(futures):
+                        file_path = futures[future]
+                        docs[file_path], logs[file_path] = future.result()
+                        if docs[file_path] is None:
+                            advance()
+
+                    if not progress.wasCanceled():
+                        progress.setLabelText("Saving projects...")
+                    futures = {executor.submit(self.save_project, doc, file_path): file_path
+                               for file_path, doc in docs.items() if doc is not None}
+                    for future in wait_for(futures):
+                        logs[futures[future]].extend(future.result())
+                        advance()
+        finally:
+            progress.close()
+            for button in buttons:
+                button.setEnabled(True)
+
+        log = [entry for file_path in file_paths for entry in logs.get(file_path, [])]
+        if finished < len(file_paths):
+            log.append((f"Cancelled, {len(file_paths) - finished} projects were not processed", "red"))
+        return log
 
     def select_project(self):
+        selected_assets = self.get_selected_assets()
+        if not selected_assets:
+            self.warn_no_assets()
+            return
+
         file_dialog = QtWidgets.QFileDialog(self, "Select Metashape Project")
         file_dialog.setFileMode(QtWidgets.QFileDialog.ExistingFiles)
         file_dialog.setNameFilter("Metashape Projects (*.psz *.psx)")
@@ -140,109 +369,123 @@ class CleanUpDlg(QtWidgets.QDialog):
         
         if file_dialog.exec_():
             file_paths = file_dialog.selectedFiles()
-            selected_assets = self.get_selected_assets()
-            log = []
-
-            if selected_assets:
-                if self.confirm_removal(selected_assets, file_paths):
-                    for file_path in file_paths:
-                        try:
-                            doc = Metashape.Document()
-                            doc.open(file_path)
-                            chunk = doc.chunk
-                            for asset in selected_assets:
-                                success = self.handle_assets(chunk, asset)
-                                if success:
-                                    log.append((f"Successfully removed {asset} from {file_path}", "black"))
-                                else:
-                                    log.append((f"Failed to remove {asset} from {file_path}", "red"))
-                            doc.save()
-                        except Exception as e:
-                            log.append((f"Failed to open or process {file_path}: {e}", "red"))
-                    self.show_log(log)
+
+            if self.confirm_removal(selected_assets, file_paths):
+                self.show_log(self.clean_projects(file_paths, selected_assets))
 
     def remove_from_subfolders(self):
+        selected_assets = self.get_selected_assets()
+        if not selected_assets:
+            self.warn_no_assets()
+            return
+
         folder_dialog = QtWidgets.QFileDialog(self, "Select Folder")
         folder_dialog.setFileMode(QtWidgets.QFileDialog.Directory)
         folder_dialog.setOptions(QtWidgets.QFileDialog.DontUseNativeDialog)
         folder_dialog.setOption(QtWidgets.QFileDialog.ShowDirsOnly, True)
+        folder_dialog.setDirectory(self.settings.value("last_folder", ""))
         
         if folder_dialog.exec_():
             folder_path = folder_dialog.selectedFiles()[0]
-            file_paths = []
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    if file.lower().endswith(('.psz', '.psx')):
-                        file_paths.append(os.path.join(root, file))
-            
-            if file_paths:
-                # Show project selection table
-                self.project_selection_table(file_paths)
+            self.settings.setValue("last_folder", folder_path)
+            # Show project selection table, filled while the folder is being scanned
+            skipped = []
+            self.project_selection_table(_iter_projects(folder_path, skipped), selected_assets, skipped)
     
-    def project_selection_table(self, file_paths):
+    def project_selection_table(self, projects, selected_assets, skipped):
         dialog = QtWidgets.QDialog(self)
         dialog.setWindowTitle("Select Projects to Clean")
         layout = QtWidgets.QVBoxLayout(dialog)
 
         # "Select All" and "Deselect All" buttons
         select_all_button = QtWidgets.QPushButton("Select All", dialog)
-        select_all_button.clicked.connect(lambda: self.toggle_select_all(checkboxes, True))
+        select_all_button.clicked.connect(lambda: self.toggle_select_all(table, True))
         layout.addWidget(select_all_button)
 
         deselect_all_button = QtWidgets.QPushButton("Deselect All", dialog)
-        deselect_all_button.clicked.connect(lambda: self.toggle_select_all(checkboxes, False))
+        deselect_all_button.clicked.connect(lambda: self.toggle_select_all(table, False))
         layout.addWidget(deselect_all_button)
 
-        table = QtWidgets.QTableWidget(len(file_paths), 2, dialog)
+        table = QtWidgets.QTableWidget(0, 2, dialog)
         table.setHorizontalHeaderLabels(["Project Path", "Select"])
         table.setColumnWidth(0, 400)
         table.setColumnWidth(1, 60)
-        
-        checkboxes = []
-        for i, path in enumerate(file_paths):
-            table.setItem(i, 0, QtWidgets.QTableWidgetItem(path))
-            checkbox = QtWidgets.QCheckBox()
-            checkbox.setChecked(True)  # Default to selecting all
-            table.setCellWidget(i, 1, checkbox)
-            checkboxes.append(checkbox)
+        table.setSortingEnabled(False)
         
         layout.addWidget(table)
 
+        skipped_label = QtWidgets.QLabel(dialog)
+        skipped_label.hide()
+        layout.addWidget(skipped_label)
+
+        file_paths = []
+
+        def load_batch():
+            # Stop scanning once the dialog has been closed
+            if not dialog.isVisible():
+                return
+            # Add rows for at most TABLE_BATCH_SIZE projects or SCAN_TICK_SECONDS per tick
+            table.setUpdatesEnabled(False)
+            table.blockSignals(True)
+            count = 0
+            exhausted = False
+            deadline = time.monotonic() + SCAN_TICK_SECONDS
+            while count < TABLE_BATCH_SIZE and time.monotonic() < deadline:
+                try:
+                    path = next(projects)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if path is None:
+                    continue
+                i = table.rowCount()
+                table.insertRow(i)
+                table.setItem(i, 0, QtWidgets.QTableWidgetItem(path))
+                item = QtWidgets.QTableWidgetItem()
+                item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsSelectable)
+                item.setCheckState(QtCore.Qt.Checked)  # Default to selecting all
+                table.setItem(i, 1, item)
+                file_paths.append(path)
+                count += 1
+            table.blockSignals(False)
+            table.setUpdatesEnabled(True)
+            if skipped:
+                skipped_label.setText(f"{len(skipped)} projects were skipped because they look invalid "
+                                      f"(empty file or missing .files folder); they are listed in the log.")
+                skipped_label.show()
+
+            if not exhausted:
+                QtCore.QTimer.singleShot(0, load_batch)
+            elif not file_paths:
+                dialog.reject()
+                message = "No valid Metashape projects were found in the selected folder."
+                if skipped:
+                    message += "\n\nThese projects were skipped because they look invalid " \
+                               "(empty file or missing .files folder):\n\n" + "\n".join(skipped)
+                QtWidgets.QMessageBox.information(self, "No projects found", message)
+
+        QtCore.QTimer.singleShot(0, load_batch)
+
         ok_button = QtWidgets.QPushButton("OK", dialog)
-        ok_button.clicked.connect(lambda: self.process_selected_projects(dialog, file_paths, checkboxes))
+        ok_button.clicked.connect(lambda: self.process_selected_projects(dialog, file_paths, table, selected_assets, skipped))
         layout.addWidget(ok_button)
 
         dialog.exec_()
 
-    def toggle_select_all(self, checkboxes, state):
+    def toggle_select_all(self, table, state):
         # Toggles all checkboxes based on the "Select All" or "Deselect All" button state
-        for checkbox in checkboxes:
-            checkbox.setChecked(state)
+        check_state = QtCore.Qt.Checked if state else QtCore.Qt.Unchecked
+        for row in range(table.rowCount()):
+            table.item(row, 1).setCheckState(check_state)
 
-    def process_selected_projects(self, dialog, file_paths, checkboxes):
-        selected_files = [file_paths[i] for i, checkbox in enumerate(checkboxes) if checkbox.isChecked()]
+    def process_selected_projects(self, dialog, file_paths, table, selected_assets, skipped):
+        selected_files = [file_paths[i] for i in range(table.rowCount())
+                          if table.item(i, 1).checkState() == QtCore.Qt.Checked]
         dialog.close()
-        if selected_files:
-            selected_assets = self.get_selected_assets()
-            log = []
-
-            if selected_assets:
-                if self.confirm_removal(selected_assets, selected_files):
-                    for file_path in selected_files:
-                        try:
-                            doc = Metashape.Document()
-                            doc.open(file_path)
-                            chunk = doc.chunk
-                            for asset in selected_assets:
-                                success = self.handle_assets(chunk, asset)
-                                if success:
-                                    log.append((f"Successfully removed {asset} from {file_path}", "black"))
-                                else:
-                                    log.append((f"Failed to remove {asset} from {file_path}", "red"))
-                            doc.save()
-                        except Exception as e:
-                            log.append((f"Failed to open or process {file_path}: {e}", "red"))
-                    self.show_log(log)
+        if selected_files and self.confirm_removal(selected_assets, selected_files):
+            skipped_log = [(f"Skipped {path}: looks invalid (empty file or missing .files folder)", "red")
+                           for path in skipped]
+            self.show_log(skipped_log + self.clean_projects(selected_files, selected_assets))
 
     def show_log(self, log):
         log_dialog = QtWidgets.QDialog(self)
@@ -253,9 +496,10 @@ class CleanUpDlg(QtWidgets.QDialog):
         log_text = QtWidgets.QTextEdit(log_dialog)
         log_text.setReadOnly(True)
         log_text.setStyleSheet("QTextEdit {font-family: Consolas; font-size: 10pt;}")
-        log_text.setText("<br>".join(
-            [f'<span style="color:{color};">{message}</span>' for message, color in log]
-        ))
+        parts = []
+        for message, color in log:
+            parts.append(f'<span style="color:{color};">{escape(message)}</span><br>')
+        log_text.setHtml(''.join(parts))
         log_text.setMinimumHeight(200)
 
         layout.addWidget(log_text)